@@ -2,12 +2,41 @@
 
 import os
 import sys
+import mmap
+import time
 import uuid
+import errno
+import random
+import fcntl
+import signal
+import multiprocessing
 import shutil
 import logging
 import argparse
+import tempfile
 import traceback
 import subprocess
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+
+# Exit codes of the SRA toolkit (e.g. bad arguments) which retrying will not fix
+USAGE_EXIT_CODES = [3]
+
+# Free space needed to decode an accession, as a multiple of its download size
+DECODE_SPACE_FACTOR = 10
+
+# A single S3 client (and HTTPS connection pool) shared by every upload,
+# with the pool split between any uploads which run at the same time
+S3_MAX_CONNECTIONS = 32
+session = boto3.session.Session()
+s3 = session.client(
+    "s3",
+    config=Config(max_pool_connections=S3_MAX_CONNECTIONS, tcp_keepalive=True)
+)
 
 
 def exit_and_clean_up(temp_folder):
@@ -17,6 +46,12 @@ def exit_and_clean_up(temp_folder):
     exc_type, exc_value, exc_traceback = sys.exc_info()
     for line in traceback.format_tb(exc_traceback):
         logging.info(line)
+    # Failures in worker processes carry the worker's own traceback as their cause
+    if exc_value is not None and exc_value.__cause__ is not None:
+        cause = exc_value.__cause__
+        logging.info("Caused by:")
+        for line in traceback.format_exception(type(cause), cause, cause.__traceback__):
+            logging.info(line)
 
     # Delete any files that were created for this sample
     logging.info("Removing temporary folder: " + temp_folder)
@@ -28,104 +63,346 @@ def exit_and_clean_up(temp_folder):
     sys.exit(exc_value)
 
 
-def run_cmds(commands, retry=0, catchExcept=False, stdout=None):
-    """Run commands and write out the log, combining STDOUT & STDERR."""
+def stop_on_sigterm(signum, frame):
+    """Unwind a worker process on SIGTERM, so that its running command is killed too."""
+    raise SystemExit("Worker terminated")
+
+
+def init_worker(pids):
+    """Set up a worker process for fetching accessions, reporting its PID."""
+    signal.signal(signal.SIGTERM, stop_on_sigterm)
+    pids.put(os.getpid())
+
+
+def start_workers(n_workers):
+    """Start a pool of worker processes, along with a queue of their PIDs."""
+    pids = multiprocessing.SimpleQueue()
+    executor = ProcessPoolExecutor(
+        max_workers=n_workers, initializer=init_worker, initargs=(pids,)
+    )
+    return executor, pids
+
+
+def terminate_workers(executor, pids, grace_period=10):
+    """Cancel any queued work in a process pool and stop its running workers."""
+    worker_pids = set()
+    while not pids.empty():
+        worker_pids.add(pids.get())
+    processes = [
+        process for process in multiprocessing.active_children()
+        if process.pid in worker_pids
+    ]
+    executor.shutdown(wait=False, cancel_futures=True)
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.join(grace_period)
+        if process.is_alive():
+            process.kill()
+
+
+def log_output(fo, label, block_size=1 << 20):
+    """Log the contents of a file of subprocess output, one block at a time."""
+    fo.seek(0)
+    for block in iter(lambda: fo.read(block_size), b''):
+        logging.info("%s:\n%s", label, block.decode("latin-1"))
+
+
+def run_cmds(commands, retry=0, catchExcept=False, stdout=None, timeout=None):
+    """Run commands and write out the log, combining STDOUT & STDERR.
+
+    If stdout is an open file object, STDOUT is written there and only STDERR is logged.
+    Failed commands are retried with exponential backoff, unless they failed on usage.
+    """
     logging.info("Commands:")
     logging.info(' '.join(commands))
-    if stdout is None:
-        p = subprocess.Popen(commands,
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.STDOUT)
-        stdout, stderr = p.communicate()
+    for attempt in range(retry + 1):
+        # Spool the output to disk rather than holding it all in memory
+        with tempfile.TemporaryFile() as output:
+            try:
+                if stdout is None:
+                    p = subprocess.run(commands,
+                                       stdout=output,
+                                       stderr=subprocess.STDOUT,
+                                       timeout=timeout)
+                else:
+                    p = subprocess.run(commands,
+                                       stdout=stdout,
+                                       stderr=output,
+                                       timeout=timeout)
+                exitcode = p.returncode
+            except subprocess.TimeoutExpired:
+                logging.info("Command timed out after {} seconds".format(timeout))
+                exitcode = None
+            if stdout is None:
+                log_output(output, "Standard output of subprocess")
+            else:
+                log_output(output, "Standard error of subprocess")
+
+        # Check the exit code (None if the command timed out)
+        if exitcode == 0:
+            return
+        if exitcode is None:
+            failure = "Timed out after {} seconds".format(timeout)
+        else:
+            failure = "Exit code {}".format(exitcode)
+        if exitcode in USAGE_EXIT_CODES:
+            logging.info("{} is a usage error, not retrying".format(failure))
+            break
+        if attempt < retry:
+            delay = min(2 ** attempt, 60) + random.random()
+            msg = "{}, retrying {} more times in {:.1f} seconds"
+            logging.info(msg.format(failure, retry - attempt, delay))
+            time.sleep(delay)
+
+    if catchExcept:
+        msg = "{}, but we will continue anyway"
+        logging.info(msg.format(failure))
     else:
-        with open(stdout, "wt") as fo:
-            p = subprocess.Popen(commands,
-                                 stderr=subprocess.PIPE,
-                                 stdout=fo)
-            stdout, stderr = p.communicate()
-        stdout = False
-    exitcode = p.wait()
-    if stdout:
-        logging.info("Standard output of subprocess:")
-        for line in stdout.decode("latin-1").split('\n'):
-            logging.info(line)
-    if stderr:
-        logging.info("Standard error of subprocess:")
-        for line in stderr.decode("latin-1").split('\n'):
-            logging.info(line)
+        assert exitcode == 0, failure
+
+
+def upload_to_s3(local_fp, s3_path, max_concurrency=16):
+    """Upload a local file to S3 with server-side encryption, using up to max_concurrency connections."""
+    assert s3_path.startswith("s3://"), "Not an S3 path: {}".format(s3_path)
+    bucket, key = s3_path[len("s3://"):].split("/", 1)
+
+    logging.info("Uploading {} to {}".format(local_fp, s3_path))
+    with open(local_fp, "rb") as fi:
+        s3.upload_fileobj(
+            fi, bucket, key,
+            Config=TransferConfig(
+                multipart_chunksize=32 * 1024 * 1024,
+                max_concurrency=max_concurrency,
+                use_threads=True
+            ),
+            ExtraArgs={"ServerSideEncryption": "AES256"}
+        )
+
+
+def copy_file(fp, fo):
+    """Copy a file into an open binary file object, within the kernel if possible."""
+    fo.flush()
+    with open(fp, "rb") as fi:
+        size = os.fstat(fi.fileno()).st_size
+        offset = 0
+        try:
+            while offset < size:
+                sent = os.sendfile(fo.fileno(), fi.fileno(), offset, size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+        except OSError as e:
+            if e.errno not in (errno.EINVAL, errno.ENOSYS):
+                raise
+            # Older kernels cannot sendfile into a pipe, so copy the rest by hand
+            logging.info("Falling back to copying {} in user space".format(fp))
+            fi.seek(offset)
+            shutil.copyfileobj(fi, fo, length=4 * 1024 * 1024)
+
+
+def count_lines(fp, block_size=1 << 22):
+    """Count the number of lines in a file."""
+    nlines = 0
+    with open(fp, "rb") as fi:
+        for block in iter(lambda: fi.read(block_size), b''):
+            nlines += block.count(b'\n')
+    return nlines
+
+
+def looks_paired(fwd_fp, rev_fp, nbytes=1 << 18):
+    """Check that the first reads in a pair of FASTQ files have matching /1 and /2 headers."""
+    headers = []
+    for fp in [fwd_fp, rev_fp]:
+        with open(fp, "rb") as fi:
+            lines = fi.read(nbytes).split(b'\n')
+        # Only use the complete records in the first block
+        lines = lines[:(len(lines) - 1) // 4 * 4]
+        headers.append(lines[0::4])
+    fwd_headers, rev_headers = headers
+    # Two empty files are trivially in step, but if there isn't a complete
+    # record to compare (e.g. very long reads), don't assume anything
+    if os.path.getsize(fwd_fp) == 0 and os.path.getsize(rev_fp) == 0:
+        return True
+    if len(fwd_headers) == 0 or len(rev_headers) == 0:
+        return False
+    return all(
+        fwd_header.endswith(b'/1') and rev_header.endswith(b'/2') and
+        fwd_header[:-2] == rev_header[:-2]
+        for fwd_header, rev_header in zip(fwd_headers, rev_headers)
+    )
 
-    # Check the exit code
-    if exitcode != 0 and retry > 0:
-        msg = "Exit code {}, retrying {} more times".format(exitcode, retry)
-        logging.info(msg)
-        run_cmds(commands, retry=retry - 1)
-    elif exitcode != 0 and catchExcept:
-        msg = "Exit code was {}, but we will continue anyway"
-        logging.info(msg.format(exitcode))
-    else:
-        assert exitcode == 0, "Exit code {}".format(exitcode)
 
+def iter_lines(fp, block_size, readahead_blocks=4):
+    """Yield the complete lines (without newlines) in each block of a file."""
+    with open(fp, "rb") as fi:
+        size = os.fstat(fi.fileno()).st_size
+        if size == 0:
+            return
+        with mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            # The file is read once from start to end, so ask for aggressive readahead
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+            start = 0
+            advised = 0
+            released = 0
+            while start < size:
+                # End each block after the last newline it contains
+                end = min(start + block_size, size)
+                if end < size:
+                    cut = mm.rfind(b'\n', start, end)
+                    if cut == -1:
+                        cut = mm.find(b'\n', end)
+                    end = size if cut == -1 else cut + 1
+                # Prefetch the next few blocks, rather than the whole file at once
+                advise_to = min(end + readahead_blocks * block_size, size)
+                if advise_to > advised:
+                    mm.madvise(mmap.MADV_WILLNEED, advised, advise_to - advised)
+                    advised = advise_to - advise_to % mmap.PAGESIZE
+
+                lines = mm[start:end].split(b'\n')
+                if lines[-1] == b'':
+                    lines.pop()
+
+                # Drop the pages which have been copied out already
+                release_to = end - end % mmap.PAGESIZE
+                if release_to > released:
+                    mm.madvise(mmap.MADV_DONTNEED, released, release_to - released)
+                    released = release_to
+
+                yield lines
+                start = end
+
+
+def interleave_fastq(fwd_fp, rev_fp, fo, block_size=1 << 18):
+    """Interleave a pair of FASTQ files, writing to an open binary file object."""
+    fwd_blocks = iter_lines(fwd_fp, block_size)
+    rev_blocks = iter_lines(rev_fp, block_size)
+    fwd_lines, rev_lines = [], []
+    fwd_done, rev_done = False, False
+    nreads = 0
+    while True:
+        # Top up whichever file has fewer lines waiting to be written
+        if not fwd_done and (rev_done or len(fwd_lines) <= len(rev_lines)):
+            lines = next(fwd_blocks, None)
+            if lines is None:
+                fwd_done = True
+            else:
+                fwd_lines.extend(lines)
+        elif not rev_done:
+            lines = next(rev_blocks, None)
+            if lines is None:
+                rev_done = True
+            else:
+                rev_lines.extend(lines)
+        else:
+            break
+
+        # Write out every complete pair of reads which has been read so far,
+        # alternating four lines from each file
+        n = min(len(fwd_lines), len(rev_lines)) // 4 * 4
+        if n == 0:
+            continue
+        comb = [None] * (2 * n)
+        for ix in range(4):
+            comb[ix::8] = fwd_lines[ix:n:4]
+            comb[ix + 4::8] = rev_lines[ix:n:4]
+        comb.append(b'')
+        fo.write(b'\n'.join(comb))
+        del fwd_lines[:n]
+        del rev_lines[:n]
+        nreads += n // 4
+
+    assert len(fwd_lines) == 0 and len(rev_lines) == 0, \
+        "Paired FASTQ files contain different numbers of reads"
+    logging.info("Interleaved {:,} pairs of reads".format(nreads))
 
-def set_up_sra_cache_folder(temp_folder):
-    """Set up the fastq-dump cache folder within the temp folder."""
-    logging.info("Setting up fastq-dump cache within {}".format(temp_folder))
 
-    cache_folder = os.path.join(temp_folder, "sra_cache")
-    os.mkdir(cache_folder)
+def folder_size(folder):
+    """Get the total size of the files in a folder (such as a downloaded accession)."""
+    return sum(
+        entry.stat().st_size
+        for entry in os.scandir(folder)
+        if entry.is_file()
+    )
 
-    run_cmds([
-        "vdb-config", "--root", "-s", "/repository/user/main/public/root={}".format(cache_folder)
-    ], catchExcept=True)
 
+def free_space(folder):
+    """Get the number of bytes free on the filesystem holding a folder."""
+    stats = os.statvfs(folder)
+    return stats.f_bavail * stats.f_frsize
+
+
+@contextmanager
+def gzip_writer(local_path, threads):
+    """Open a pipe into igzip, which compresses everything written into local_path."""
+    # Compress the reads as they are written, rather than after the fact,
+    # with the ISA-L igzip compressor (SIMD-accelerated deflate and CRC32)
+    with open(local_path, "wb") as fo:
+        gzip = subprocess.Popen(
+            ["igzip", "-1", "-T", str(threads), "-c"],
+            stdin=subprocess.PIPE,
+            stdout=fo
+        )
+        # Enlarge the pipe to igzip so that each interleaved block is handed over
+        # in a few large writes, while staying small enough to remain in cache
+        try:
+            fcntl.fcntl(gzip.stdin.fileno(), fcntl.F_SETPIPE_SZ, 1 << 20)
+        except OSError as e:
+            logging.info("Could not resize the pipe to igzip: {}".format(e))
 
-def interleave_fastq(fwd_fp, rev_fp, comb_fp):
-    fwd = open(fwd_fp, "rt")
-    rev = open(rev_fp, "rt")
-    nreads = 0
-    with open(comb_fp, "wt") as fo:
-        while True:
-            fwd_read = [fwd.readline() for ix in range(4)]
-            rev_read = [rev.readline() for ix in range(4)]
-            if any([l == '' for l in fwd_read]):
-                break
-            assert any([l == '' for l in rev_read]) is False
-            nreads += 1
-            fo.write(''.join(fwd_read))
-            fo.write(''.join(rev_read))
-    fwd.close()
-    rev.close()
-    logging.info("Interleaved {:,} pairs of reads".format(nreads))
+        broken_pipe = False
+        try:
+            yield gzip.stdin
+        except BrokenPipeError:
+            # igzip has exited early, and its exit code below says why
+            broken_pipe = True
+        finally:
+            # Let igzip finish compressing whatever has been written, and
+            # always reap it, even if flushing the last of the data fails
+            try:
+                gzip.stdin.close()
+            except BrokenPipeError:
+                broken_pipe = True
+            exitcode = gzip.wait()
+    assert exitcode == 0, "Exit code {}".format(exitcode)
+    assert not broken_pipe, "igzip stopped reading before all reads were written"
+
+
+def download_accession(accession, temp_folder, timeout=None):
+    """Download a single SRA accession into temp_folder, giving up on each attempt after timeout seconds."""
+    logging.info("Downloading {} via prefetch".format(accession))
+    os.mkdir(temp_folder)
 
+    run_cmds([
+        "prefetch", "--output-directory", temp_folder, accession
+    ], retry=3, timeout=timeout)
 
-def get_sra(accession_string, temp_folder):
-    """Get the FASTQ for an SRA accession."""
-    logging.info("Downloading {} from SRA".format(accession_string))
 
-    local_path = os.path.join(temp_folder, "reads.fastq")
-    logging.info("Local path: {}".format(local_path))
-
-    # Download via fastq-dump
-    for accession in accession_string.split(","):
-        logging.info("Downloading {} via fastq-dump".format(accession))
-
-        accession_joined_fp = os.path.join(temp_folder, accession + ".all.fastq")
-
-        run_cmds([
-            "prefetch", accession
-        ])
-        # Output the _1.fastq and _2.fastq files
-        run_cmds([
-            "fastq-dump", "--split-files", 
-            "--defline-seq", "@$ac.$si.$sg/$ri", 
-            "--defline-qual", "+", 
-            "--outdir", temp_folder, accession
-        ])
-        r1 = os.path.join(temp_folder, accession + "_1.fastq")
-        r2 = os.path.join(temp_folder, accession + "_2.fastq")
-        assert os.path.exists(r1)
-
-        # If there are two reads created, interleave them
-        if os.path.exists(r2):
+def decode_accession(accession, temp_folder, threads, output_format, strict):
+    """Get the gzipped FASTQ file(s) for an SRA accession downloaded into temp_folder."""
+    logging.info("Decoding {} via fasterq-dump".format(accession))
+
+    # Output the _1.fastq and _2.fastq files, plus any unpaired reads
+    # in .fastq (--split-3), keeping the scratch files next to the output
+    run_cmds([
+        "fasterq-dump", "--split-3",
+        "--threads", str(threads),
+        "--seq-defline", "@$ac.$si.$sg/$ri",
+        "--qual-defline", "+",
+        "--temp", temp_folder,
+        "--outdir", temp_folder,
+        os.path.join(temp_folder, accession)
+    ])
+    r0 = os.path.join(temp_folder, accession + ".fastq")
+    r1 = os.path.join(temp_folder, accession + "_1.fastq")
+    r2 = os.path.join(temp_folder, accession + "_2.fastq")
+    assert os.path.exists(r1) or os.path.exists(r0)
+
+    # If there are two reads created, interleave them (or keep them apart)
+    if os.path.exists(r1) and os.path.exists(r2):
+        # With --split-3, the reads in _1.fastq and _2.fastq are usually in
+        # step already, so only fall back to fastq_pair if they appear not to be
+        if strict or not looks_paired(r1, r2):
             r1_paired = os.path.join(temp_folder, accession + "_1.fastq.paired.fq")
             r2_paired = os.path.join(temp_folder, accession + "_2.fastq.paired.fq")
 
@@ -136,41 +413,175 @@ def get_sra(accession_string, temp_folder):
             assert os.path.exists(r1_paired)
             assert os.path.exists(r2_paired)
             logging.info("Removing raw downloaded FASTQ files")
-            os.remove(r1)
-            os.remove(r2)
+            for fp in [r1, r2, r1 + ".single.fq", r2 + ".single.fq"]:
+                if os.path.exists(fp):
+                    os.remove(fp)
+            r1, r2 = r1_paired, r2_paired
+        else:
+            logging.info("Paired FASTQ files are in step, skipping fastq_pair")
+
+        # Any reads lacking a mate are set aside in .fastq
+        if os.path.exists(r0):
+            logging.info("Removing unpaired reads in {}".format(r0))
+            os.remove(r0)
 
+        if output_format == "interleaved":
             # Interleave the two paired files
             logging.info("Interleaving the paired FASTQ files")
-            interleave_fastq(r1_paired, r2_paired, accession_joined_fp)
-            assert os.path.exists(accession_joined_fp)
-            logging.info("Removing split and filtered FASTQ files")
-            os.remove(r1_paired)
-            os.remove(r2_paired)
+            local_paths = [os.path.join(temp_folder, accession + ".fastq.gz")]
+            with gzip_writer(local_paths[0], threads) as fo:
+                interleave_fastq(r1, r2, fo)
         else:
-            # Otherwise, just make the _1.fastq file the output
-            logging.info("Using {} as the output file".format(r1))
-            run_cmds(["mv", r1, accession_joined_fp])
-
-        # Remove the cache file, if any
-        logging.info("Removing cached SRA files")
-        run_cmds(["find", temp_folder, "-name", "*.sra", "-delete"])
-
-        # Append this set of reads to the total
-        logging.info("Adding reads from {} to the total".format(accession))
-        with open(local_path, "at") as fo:
-            for line in open(accession_joined_fp, "rt"):
-                fo.write(line)
-        logging.info("Removing temporary file " + accession_joined_fp)
-        os.remove(accession_joined_fp)
-
-    # Compress the FASTQ file
-    logging.info("Compress the FASTQ file")
-    run_cmds(["pigz", local_path])
-    local_path = local_path + ".gz"
-
-    # Return the path to the file
+            # Compress each of the paired files on its own, once it is clear that
+            # they hold the same number of reads (interleave_fastq checks this itself)
+            logging.info("Checking that the paired FASTQ files are the same length")
+            assert count_lines(r1) == count_lines(r2), \
+                "Paired FASTQ files contain different numbers of reads"
+            logging.info("Compressing the paired FASTQ files")
+            local_paths = [
+                os.path.join(temp_folder, accession + "_1.fastq.gz"),
+                os.path.join(temp_folder, accession + "_2.fastq.gz")
+            ]
+            for fp, local_path in zip([r1, r2], local_paths):
+                with gzip_writer(local_path, threads) as fo:
+                    copy_file(fp, fo)
+        logging.info("Removing split FASTQ files")
+        os.remove(r1)
+        os.remove(r2)
+    else:
+        # Otherwise, just compress the single-end .fastq file
+        if os.path.exists(r1):
+            r0 = r1
+        logging.info("Using {} as the output file".format(r0))
+        local_paths = [os.path.join(temp_folder, accession + ".fastq.gz")]
+        with gzip_writer(local_paths[0], threads) as fo:
+            copy_file(r0, fo)
+        os.remove(r0)
+
+    # Remove the folder holding the cached SRA files
+    logging.info("Removing cached SRA files")
+    shutil.rmtree(os.path.join(temp_folder, accession))
+
+    logging.info("Done fetching " + accession)
+    return local_paths
+
+
+def get_sra(accession_string, temp_folder, output_format="interleaved", strict=False,
+            prefetch_timeout=None):
+    """Get the FASTQ for an SRA accession, returning a list of one file (or two for paired output)."""
+    logging.info("Downloading {} from SRA".format(accession_string))
+
+    # Download and decode each accession in its own folder, splitting the
+    # CPUs between the decoding workers
+    accessions = accession_string.split(",")
+    accession_folders = [
+        os.path.join(temp_folder, "{}_{}".format(ix, accession))
+        for ix, accession in enumerate(accessions)
+    ]
+    n_workers = max(1, min(len(accessions), os.cpu_count() // 2))
+    threads = max(1, os.cpu_count() // n_workers)
+    logging.info("Fetching {} accessions with {} workers".format(
+        len(accessions), n_workers))
+
+    # Downloads run ahead of the decodes by up to one accession per worker,
+    # so the network and CPUs are both kept busy without filling the disk
+    accession_paths = [None] * len(accessions)
+    # fasterq-dump needs scratch and output space of up to ~10x the SRA file,
+    # which each running decode claims until it has finished
+    space_needed = [None] * len(accessions)
+    space_claimed = {}
+    to_download = list(range(len(accessions)))
+    to_decode = []
+    downloads, decodes = {}, {}
+    download_executor, download_pids = start_workers(n_workers)
+    decode_executor, decode_pids = start_workers(n_workers)
+    try:
+        while to_download or to_decode or downloads or decodes:
+            while to_decode and len(decodes) < n_workers:
+                ix = to_decode[0]
+                available = free_space(temp_folder)
+                claimed = sum(space_claimed.values())
+                if available < space_needed[ix] + claimed:
+                    # Wait for the running decodes to finish and release their space
+                    assert len(decodes) > 0, \
+                        "Not enough space in {} to decode {} ({:,} bytes free, {:,} needed)".format(
+                            temp_folder, accessions[ix], available, space_needed[ix])
+                    logging.info("Waiting for space in {} to decode {}".format(
+                        temp_folder, accessions[ix]))
+                    break
+                to_decode.pop(0)
+                space_claimed[ix] = space_needed[ix]
+                decode = decode_executor.submit(
+                    decode_accession,
+                    accessions[ix],
+                    accession_folders[ix],
+                    threads,
+                    output_format,
+                    strict
+                )
+                decodes[decode] = ix
+
+            while to_download and len(downloads) + len(to_decode) < n_workers:
+                ix = to_download.pop(0)
+                download = download_executor.submit(
+                    download_accession,
+                    accessions[ix],
+                    accession_folders[ix],
+                    prefetch_timeout
+                )
+                downloads[download] = ix
+
+            done, _ = wait(list(downloads) + list(decodes), return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in downloads:
+                    future.result()
+                    ix = downloads.pop(future)
+                    sra_size = folder_size(
+                        os.path.join(accession_folders[ix], accessions[ix])
+                    )
+                    space_needed[ix] = DECODE_SPACE_FACTOR * sra_size
+                    logging.info("Downloaded {:,} bytes for {}".format(
+                        sra_size, accessions[ix]))
+                    to_decode.append(ix)
+                else:
+                    ix = decodes.pop(future)
+                    accession_paths[ix] = future.result()
+                    del space_claimed[ix]
+    except:
+        # Don't wait for the other accessions, as their reads won't be used
+        logging.info("Stopping the download and decoding of all accessions")
+        terminate_workers(download_executor, download_pids)
+        terminate_workers(decode_executor, decode_pids)
+        raise
+    download_executor.shutdown()
+    decode_executor.shutdown()
+
+    n_files = len(accession_paths[0])
+    assert all(len(paths) == n_files for paths in accession_paths), \
+        "Cannot combine paired and single-end accessions in paired output"
+    if n_files == 1:
+        local_paths = [os.path.join(temp_folder, "reads.fastq.gz")]
+    else:
+        local_paths = [
+            os.path.join(temp_folder, "reads_{}.fastq.gz".format(ix + 1))
+            for ix in range(n_files)
+        ]
+    logging.info("Local path(s): {}".format(", ".join(local_paths)))
+
+    # Concatenated gzip streams are themselves a valid gzip file
+    logging.info("Combining reads from {}".format(accession_string))
+    for ix, local_path in enumerate(local_paths):
+        if len(accession_paths) == 1:
+            os.rename(accession_paths[0][ix], local_path)
+            continue
+        with open(local_path, "wb") as fo:
+            for paths in accession_paths:
+                copy_file(paths[ix], fo)
+                os.remove(paths[ix])
+
+    # Return the path(s) to the file(s)
     logging.info("Done fetching " + accession_string)
-    return local_path
+    return local_paths
 
 
 if __name__ == "__main__":
@@ -184,7 +595,20 @@ if __name__ == "__main__":
     parser.add_argument("--output-path",
                         type=str,
                         required=True,
-                        help="""S3 path (key) to upload (interleaved) FASTQ [.fastq.gz].""")
+                        help="""S3 path (key) to upload (interleaved) FASTQ [.fastq.gz].
+                                (With paired output, files are written to _1.fastq.gz and _2.fastq.gz)""")
+    parser.add_argument("--output-format",
+                        type=str,
+                        choices=["interleaved", "paired"],
+                        default="interleaved",
+                        help="""Write paired reads as a single interleaved FASTQ, or as a pair of FASTQ files.""")
+    parser.add_argument("--strict",
+                        action="store_true",
+                        help="""Always isolate properly paired reads with fastq_pair, rather than only when the paired FASTQ files appear out of step.""")
+    parser.add_argument("--prefetch-timeout",
+                        type=int,
+                        default=4 * 60 * 60,
+                        help="""Seconds to wait for each attempt at downloading an accession before retrying.""")
     parser.add_argument("--temp-folder",
                         type=str,
                         default='/share',
@@ -222,42 +646,56 @@ if __name__ == "__main__":
     consoleHandler.setFormatter(logFormatter)
     rootLogger.addHandler(consoleHandler)
 
-    # Set up the NCBI fastq-dump cache folder within the temp folder
-    try:
-        set_up_sra_cache_folder(temp_folder)
-    except:
-        exit_and_clean_up(temp_folder)
-
     # Download the SRA data
     try:
-        local_fp = get_sra(args.accession, temp_folder)
+        local_fps = get_sra(args.accession, temp_folder, args.output_format, args.strict,
+                            args.prefetch_timeout)
     except:
         exit_and_clean_up(temp_folder)
 
+    # Paired output is written to _1.fastq.gz and _2.fastq.gz
+    if len(local_fps) == 1:
+        output_paths = [args.output_path]
+    else:
+        output_paths = [
+            args.output_path.replace(".fastq.gz", "_{}.fastq.gz".format(ix + 1))
+            for ix in range(len(local_fps))
+        ]
+
     if args.output_path.startswith("s3://"):
-        # Upload FASTQ to S3 folder
+        # Upload FASTQ to S3 folder, with any paired files at the same time
         try:
-            run_cmds(["aws", "s3", "cp", "--sse", "AES256",
-                      local_fp, args.output_path])
+            with ThreadPoolExecutor(max_workers=len(local_fps)) as executor:
+                max_concurrency = min(16, S3_MAX_CONNECTIONS // len(local_fps))
+                uploads = [
+                    executor.submit(upload_to_s3, local_fp, output_path, max_concurrency)
+                    for local_fp, output_path in zip(local_fps, output_paths)
+                ]
+                for upload in uploads:
+                    upload.result()
         except:
             exit_and_clean_up(temp_folder)
 
-        # Upload logs to S3 folder
+        # Upload logs to S3 folder, once they record how the upload went
         try:
-            run_cmds(["aws", "s3", "cp", "--sse",
-                      "AES256", log_fp, args.output_path.replace(".fastq.gz", ".log")])
+            logging.info("Done uploading FASTQ to S3")
+            upload_to_s3(log_fp, args.output_path.replace(".fastq.gz", ".log"))
         except:
             exit_and_clean_up(temp_folder)
     else:
         # Move FASTQ to local folder
         try:
-            run_cmds(["mv", local_fp, args.output_path])
+            for local_fp, output_path in zip(local_fps, output_paths):
+                logging.info("Moving {} to {}".format(local_fp, output_path))
+                shutil.move(local_fp, output_path)
         except:
             exit_and_clean_up(temp_folder)
 
         # Move logs to local folder
         try:
-            run_cmds(["mv", log_fp, args.output_path.replace(".fastq.gz", ".log")])
+            log_path = args.output_path.replace(".fastq.gz", ".log")
+            logging.info("Moving {} to {}".format(log_fp, log_path))
+            shutil.move(log_fp, log_path)
         except:
             exit_and_clean_up(temp_folder)
     